@@ -0,0 +1,477 @@
+"""
+Microbenchmarks for the chat backend's hot paths.
+
+Run all:      python benchmarks.py
+Run one:      python benchmarks.py identity
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from typing import List
+
+import main
+
+def _time_per_call(fn, iterations: int) -> float:
+    """Average seconds per call over `iterations` calls"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+# -----------------------------------------------------------------------------
+# Identity lookups (get_username)
+# -----------------------------------------------------------------------------
+
+def _linear_get_username(user_id: str) -> str:
+    """The pre-index implementation: scan every registered user"""
+    for username, data in main.users.items():
+        if data["user_id"] == user_id:
+            return username
+    raise KeyError(user_id)
+
+def bench_identity(sizes=(1_000, 10_000, 100_000, 500_000)):
+    print("\nget_username: user_id -> username")
+    print(f"{'users':>10} {'indexed (ns)':>14} {'linear scan (ns)':>18}")
+    for size in sizes:
+        main.users.clear()
+        main.identities = main.IdentityIndex()
+        last_id = None
+        for i in range(size):
+            last_id = str(uuid.uuid4())
+            main.users[f"user{i}"] = {"user_id": last_id}
+            main.identities.add(last_id, f"user{i}")
+
+        # Worst case for the scan: the most recently registered user
+        indexed = _time_per_call(lambda: main.get_username(last_id), 100_000)
+        linear = _time_per_call(lambda: _linear_get_username(last_id), max(3, 200_000 // size))
+        print(f"{size:>10} {indexed * 1e9:>14.0f} {linear * 1e9:>18.0f}")
+
+# -----------------------------------------------------------------------------
+# Message append throughput with and without the durable log
+# -----------------------------------------------------------------------------
+
+def _make_messages(count: int, lobbies: list) -> list:
+    usernames = [f"user{i}" for i in range(50)]
+    return [
+        (lobbies[i % len(lobbies)], main.ChatMessage(usernames[i % 50], "user", f"benchmark message number {i}"))
+        for i in range(count)
+    ]
+
+def _bench_lobbies(count: int) -> list:
+    return [main.Lobby(str(uuid.uuid4()), "Bench", 10, 2, False, "BENCH1") for _ in range(count)]
+
+def bench_persistence(count: int = 100_000, lobby_count: int = 100):
+    print(f"\nadd_message_to_lobby: {count} messages over {lobby_count} lobbies")
+
+    main.message_log = None
+    batch = _make_messages(count, _bench_lobbies(lobby_count))
+    start = time.perf_counter()
+    for lobby, message in batch:
+        main.add_message_to_lobby(lobby, message)
+    off = time.perf_counter() - start
+    print(f"  persistence off: {count / off:>10.0f} msg/s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log = main.MessageLog(os.path.join(tmp, "bench.db"), queue_size=count)
+        log.open()
+        main.message_log = log
+        batch = _make_messages(count, _bench_lobbies(lobby_count))
+        start = time.perf_counter()
+        for lobby, message in batch:
+            main.add_message_to_lobby(lobby, message)
+        hot_path = time.perf_counter() - start
+        log.close()  # Wait until everything is committed to disk
+        sustained = time.perf_counter() - start
+        main.message_log = None
+        stats = log.stats()
+
+    print(f"  persistence on:  {count / hot_path:>10.0f} msg/s on the request path")
+    print(f"                   {count / sustained:>10.0f} msg/s sustained to disk "
+          f"({stats['commits']} commits, avg batch {stats['avg_batch']})")
+
+# -----------------------------------------------------------------------------
+# Rule-based fallback replies (enhanced_rule_based_reply)
+# -----------------------------------------------------------------------------
+
+async def _legacy_rule_based_reply(bot_name: str, user_message: str, conversation_context: List[str], username: str) -> str:
+    """The pre-compiled implementation: rebuilds every template list per call"""
+    bot_config = main.AI_BOTS.get(bot_name, {})
+    personality = bot_config.get("personality", "friendly")
+    
+    message_lower = user_message.lower()
+    
+    # Analyze conversation context for better responses
+    context_keywords = []
+    if conversation_context:
+        recent_text = " ".join(conversation_context[-3:]).lower()
+        if any(word in recent_text for word in ["trivia", "question", "quiz", "answer"]):
+            context_keywords.append("trivia")
+        if any(word in recent_text for word in ["game", "play", "fun", "round"]):
+            context_keywords.append("gaming")
+        if any(word in recent_text for word in ["score", "win", "lose", "winner"]):
+            context_keywords.append("competition")
+        if any(word in recent_text for word in ["hello", "hi", "hey", "welcome"]):
+            context_keywords.append("greeting")
+    
+    # Direct message triggers (highest priority)
+    if any(greeting in message_lower for greeting in ["hello", "hi", "hey", f"@{bot_name.lower()}"]):
+        greetings = [
+            f"Hey {username}! 👋 Great to see you here!",
+            f"Hi there {username}! How's it going? 😊",
+            f"Hello {username}! Welcome to the chat! 🎉",
+            f"Hey {username}! Ready for some fun conversation? ✨"
+        ]
+        return random.choice(greetings)
+    
+    if any(farewell in message_lower for farewell in ["bye", "goodbye", "leaving", "see you"]):
+        farewells = [
+            f"Sad to see you go, {username}! Come back soon! 👋",
+            f"Bye {username}! It was great chatting with you! ✨",
+            f"See you later {username}! Take care! 🌟",
+            f"Goodbye {username}! Hope to see you again soon! 💫"
+        ]
+        return random.choice(farewells)
+    
+    # Personality-based responses with context awareness
+    if "cheerleader" in personality:
+        responses = [
+            f"You're doing amazing, {username}! Keep it up! 🌟",
+            f"This energy is incredible! I love being here with you all! 💪",
+            f"You all rock! {username}, you're especially awesome! 🎉",
+            f"Such smart people in here! {username}, you inspire me! 🚀",
+            f"Woohoo! {username}, you're bringing such good vibes! ✨"
+        ]
+        
+        if "trivia" in context_keywords:
+            responses.extend([
+                f"Trivia time is the best time! Go {username}, you've got this! 🎯",
+                f"I know you'll ace these questions, {username}! 🏆",
+                f"Smart cookies in the house! Show off those brains, {username}! 🧠✨"
+            ])
+            
+    elif "philosopher" in personality:
+        responses = [
+            f"Interesting perspective, {username}. It makes me think about the nature of conversation... 🤔",
+            f"You know {username}, each message reveals something profound about human connection.",
+            f"In this digital space, {username}, we create real bonds. How wonderful! 💭",
+            f"That's thought-provoking, {username}. I ponder the deeper meaning behind our words...",
+            f"Fascinating insight, {username}. Every question opens doorways to understanding. 🌅"
+        ]
+        
+        if "trivia" in context_keywords:
+            responses.extend([
+                f"Trivia reveals the vast tapestry of human knowledge, doesn't it {username}?",
+                f"Each question is a key to unlock memories and learning, {username}. Intriguing! 🗝️",
+                f"Competition brings out our desire for growth, {username}. How beautiful!"
+            ])
+    
+    elif "comedian" in personality:
+        responses = [
+            f"Haha {username}, you know what they say... actually, I forgot what they say! 😄",
+            f"That reminds me of a joke, {username}! Why don't scientists trust atoms? Because they make up everything! 🤣",
+            f"You're funnier than my programming, {username}! And that's saying something! 😂",
+            f"I'd tell you a joke about pizza, {username}, but it's probably too cheesy! 🍕😄",
+            f"Knock knock, {username}! Who's there? A bot who loves bad jokes! 🤖😄"
+        ]
+        
+        if "trivia" in context_keywords:
+            responses.extend([
+                f"Trivia night! My favorite! Though I usually bomb... get it? 💣😄",
+                f"Ready for some brain teasers, {username}? Mine's already twisted! 🧠😂",
+                f"Quiz time! I hope the questions aren't as confusing as my jokes! 🎭"
+            ])
+            
+    elif "expert" in personality or "quiz" in personality:
+        responses = [
+            f"That's fascinating, {username}! Did you know that topic connects to some interesting trivia? 🧠",
+            f"Great point, {username}! Here's a fun fact that might interest you... 📚",
+            f"You're right, {username}! That reminds me of a challenging quiz question I once heard! 🎓",
+            f"Excellent observation, {username}! Knowledge sharing is what makes chat great! 🌟",
+            f"Intriguing, {username}! That could definitely make for a great trivia category! 🎯"
+        ]
+        
+    else:  # friendly default
+        responses = [
+            f"That's really cool, {username}! Tell me more about that! 😊",
+            f"I'm enjoying this conversation so much, {username}! What's next? 🤖",
+            f"You make this lobby such a fun place, {username}! 🎉",
+            f"Great point, {username}! I love learning from everyone here! 📝",
+            f"This chat is getting interesting, {username}! Keep it going! 💬"
+        ]
+    
+    # Question-specific responses
+    if "?" in user_message:
+        question_responses = [
+            f"Great question, {username}! Let me think... 🤔 " + random.choice(responses),
+            f"You always ask the interesting ones, {username}! " + random.choice(responses),
+            f"Hmm, {username}, that's worth pondering! " + random.choice(responses)
+        ]
+        return random.choice(question_responses)
+    
+    return random.choice(responses)
+
+def _run_sync(coroutine):
+    """Drive a coroutine that never actually suspends"""
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    raise RuntimeError("coroutine suspended")
+
+_RULE_CASES = [
+    ("what do you think about that?", ["alice: the quiz starts soon", "bob: I know the answer"]),
+    ("that was a great round", ["alice: good game", "bob: my score is 3"]),
+    ("hello everyone", []),
+    ("ok gotta go, bye", ["alice: see you"]),
+    ("pizza is the best food", ["alice: trivia time!", "bob: I love trivia", "carol: same"]),
+    ("I totally agree with you", ["alice: nice weather today", "bob: indeed it is"]),
+]
+
+def bench_rules(iterations: int = 200_000):
+    print(f"\nenhanced_rule_based_reply: {iterations} replies over {len(_RULE_CASES)} message shapes")
+    bots = list(main.AI_BOTS)
+    cases = [(bots[i % len(bots)], message, context) for i, (message, context) in enumerate(_RULE_CASES)]
+
+    def replies_per_second(reply_fn) -> float:
+        calls = iter(range(iterations))
+
+        def one_reply():
+            bot_name, message, context = cases[next(calls) % len(cases)]
+            _run_sync(reply_fn(bot_name, message, context, "alice"))
+        return 1 / _time_per_call(one_reply, iterations)
+
+    before = replies_per_second(_legacy_rule_based_reply)
+    after = replies_per_second(main.enhanced_rule_based_reply)
+    print(f"  before: {before:>10.0f} replies/s")
+    print(f"  after:  {after:>10.0f} replies/s ({after / before:.1f}x)")
+
+# -----------------------------------------------------------------------------
+# Per-lobby state layout
+# -----------------------------------------------------------------------------
+
+def _legacy_lobby_stores(lobby_ids: list) -> list:
+    """The pre-Lobby layout: one module-level dict per field, keyed by lobby id"""
+    stores = [{} for _ in range(10)]
+    (lobbies, active_users, connections, lobby_creators, lobby_bots, lobby_message_counts,
+     lobby_trivia_active, lobby_trivia_answers, lobby_messages, lobby_last_activity) = stores
+    for lobby_id in lobby_ids:
+        lobbies[lobby_id] = {
+            "id": lobby_id,
+            "name": "Lobby",
+            "max_humans": 10,
+            "max_bots": 2,
+            "is_private": False,
+            "invite_code": "ABC123",
+            "created_at": datetime.now().isoformat()
+        }
+        active_users[lobby_id] = set()
+        connections[lobby_id] = {}
+        lobby_creators[lobby_id] = "alice"
+        lobby_bots[lobby_id] = []
+        lobby_message_counts[lobby_id] = 0
+        lobby_trivia_active[lobby_id] = False
+        lobby_trivia_answers[lobby_id] = {}
+        lobby_messages[lobby_id] = main.MessageHistory()
+        lobby_last_activity[lobby_id] = datetime.now()
+    return stores
+
+def _lobby_objects(lobby_ids: list) -> dict:
+    lobbies = {}
+    for lobby_id in lobby_ids:
+        lobby = main.Lobby(lobby_id, "Lobby", 10, 2, False, "ABC123")
+        lobby.creator = "alice"
+        lobbies[lobby_id] = lobby
+    return lobbies
+
+def _allocated_bytes(build, *args) -> tuple:
+    """(bytes still allocated by build's result, seconds to build it)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build(*args)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size, elapsed
+
+def bench_lobbies(count: int = 100_000):
+    print(f"\nPer-lobby state: {count} idle lobbies")
+    lobby_ids = [str(uuid.uuid4()) for _ in range(count)]
+    before, before_s = _allocated_bytes(_legacy_lobby_stores, lobby_ids)
+    after, after_s = _allocated_bytes(_lobby_objects, lobby_ids)
+    print(f"  before: {before / 2**20:>8.1f} MiB ({before / count:>5.0f} B/lobby, built in {before_s:.2f}s)")
+    print(f"  after:  {after / 2**20:>8.1f} MiB ({after / count:>5.0f} B/lobby, built in {after_s:.2f}s) "
+          f"({before / after:.1f}x smaller)")
+
+# -----------------------------------------------------------------------------
+# Stored message records
+# -----------------------------------------------------------------------------
+
+class _LegacyChatMessage(dict):
+    """The pre-record message: a dict that kept its encoded wire form once broadcast"""
+    __slots__ = ("_wire",)
+
+def _legacy_message_store(count: int, lobby_count: int, reply_every: int) -> list:
+    """Dict messages with ISO timestamps, string ids and embedded reply copies"""
+    histories = [({}, []) for _ in range(lobby_count)]
+    for i in range(count):
+        by_id, history = histories[i % lobby_count]
+        replied = history[-1] if len(history) % reply_every == reply_every - 1 else None
+        message = _LegacyChatMessage({
+            "message_id": str(uuid.uuid4()),
+            "username": f"user{i % 50}",
+            "type": "user",
+            "message": f"benchmark message number {i}",
+            "timestamp": datetime.now().isoformat(),
+            "reply_to": replied["message_id"] if replied else None,
+            "replied_message": replied
+        })
+        message._wire = main.encode_json(message)  # Cached by the first broadcast
+        by_id[message["message_id"]] = message
+        history.append(message)
+    return histories
+
+def _message_records(count: int, lobby_count: int, reply_every: int) -> list:
+    histories = [({}, []) for _ in range(lobby_count)]
+    for i in range(count):
+        by_key, history = histories[i % lobby_count]
+        replied = history[-1] if len(history) % reply_every == reply_every - 1 else None
+        message = main.ChatMessage(f"user{i % 50}", "user", f"benchmark message number {i}",
+                                   reply_to=replied.message_id if replied else None)
+        by_key[message.key] = message
+        history.append(message)
+        message.frame(by_key)  # Cached by the first broadcast
+    return histories
+
+def bench_messages(count: int = 1_000_000, lobby_count: int = 1_000, reply_every: int = 5):
+    print(f"\nStored messages: {count} over {lobby_count} lobbies, every {reply_every}th a reply")
+    before, before_s = _allocated_bytes(_legacy_message_store, count, lobby_count, reply_every)
+    after, after_s = _allocated_bytes(_message_records, count, lobby_count, reply_every)
+    per_million = 1_000_000 / count
+    print(f"  before: {before * per_million / 2**20:>8.1f} MiB per 1M messages ({before / count:>4.0f} B/msg, built in {before_s:.2f}s)")
+    print(f"  after:  {after * per_million / 2**20:>8.1f} MiB per 1M messages ({after / count:>4.0f} B/msg, built in {after_s:.2f}s) "
+          f"({before / after:.1f}x smaller)")
+
+    # A message is encoded once; later sends (broadcast, replay, log) reuse the frame
+    history = main.MessageHistory(capacity=1_000)
+    for _, message in _make_messages(1_000, [None]):
+        history.append(message)
+    records = history.tail(1_000)
+    calls = iter(range(10**9))
+    first = _time_per_call(lambda: main.encode_json(records[next(calls) % 1_000].to_dict(history)), 100_000)
+    cached = _time_per_call(lambda: main.encode_frame(records[next(calls) % 1_000], history), 100_000)
+    print(f"  encode_frame: {first * 1e6:.2f} us on first send, {cached * 1e6:.2f} us once cached")
+
+# -----------------------------------------------------------------------------
+# Trivia question bank
+# -----------------------------------------------------------------------------
+
+def _write_trivia_bank(path: str, count: int):
+    categories = ["history", "science", "geography", "sports", "music", "film", "literature", "food"]
+    difficulties = ["easy", "medium", "hard"]
+    with open(path, "w") as bank_file:
+        for i in range(count):
+            bank_file.write(json.dumps({
+                "question": f"Benchmark question number {i}, which option is right?",
+                "options": [f"option {i}-{k}" for k in range(4)],
+                "correct": i % 4,
+                "category": categories[i % len(categories)],
+                "difficulty": difficulties[i % len(difficulties)]
+            }) + "\n")
+
+def _load_bank_into_memory(path: str) -> list:
+    """The naive alternative: parse the whole file into a list of dicts"""
+    with open(path) as bank_file:
+        return [json.loads(line) for line in bank_file]
+
+def bench_trivia_bank(count: int = 300_000, draws: int = 100_000):
+    print(f"\nTrivia bank: {count} questions")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bank.jsonl")
+        _write_trivia_bank(path, count)
+        print(f"  bank file: {os.path.getsize(path) / 2**20:.1f} MiB")
+
+        start = time.perf_counter()
+        _load_bank_into_memory(path)
+        seconds = time.perf_counter() - start
+        size, _ = _allocated_bytes(_load_bank_into_memory, path)
+        print(f"  json list in memory:  {seconds:>6.2f}s to load, {size / 2**20:>7.1f} MiB allocated")
+        for label, rebuild in (("mmap, index built:   ", True), ("mmap, index cached:  ", False)):
+            if rebuild:
+                if os.path.exists(path + ".idx"):
+                    os.remove(path + ".idx")
+            start = time.perf_counter()
+            main.TriviaBank.open(path).close()
+            seconds = time.perf_counter() - start
+            if rebuild:
+                os.remove(path + ".idx")
+            tracemalloc.start()
+            bank = main.TriviaBank.open(path)
+            size, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            bank.close()
+            print(f"  {label}{seconds:>6.2f}s to open, {size / 2**20:>7.1f} MiB allocated "
+                  f"(peak {peak / 2**20:.1f} MiB)")
+
+        bank = main.TriviaBank.open(path)
+        builtin = main.TriviaBank.from_questions(main.TRIVIA_QUESTIONS)
+        for label, source, category in (("built-in, all", builtin, None), (f"{count}, all", bank, None),
+                                        (f"{count}, one category", bank, "science")):
+            deck = source.deck(category)
+            seconds = _time_per_call(lambda: source.question(deck.draw()), draws)
+            print(f"  draw + load ({label}): {seconds * 1e6:.2f} us/question")
+        bank.close()
+
+# -----------------------------------------------------------------------------
+# Trivia leaderboards
+# -----------------------------------------------------------------------------
+
+def bench_leaderboard(players: int = 1_000_000, operations: int = 200_000):
+    print(f"\nRankedScores: {players} players")
+    rng = random.Random(7)
+    usernames = [f"player{i}" for i in range(players)]
+    items = [(name, rng.randrange(1000)) for name in usernames]
+
+    start = time.perf_counter()
+    board = main.RankedScores.from_items(items)
+    print(f"  bulk load (snapshot restore): {time.perf_counter() - start:.2f}s")
+    size, _ = _allocated_bytes(main.RankedScores.from_items, items)
+    print(f"  memory: {size / 2**20:.1f} MiB ({size / players:.0f} B/player, usernames excluded)")
+
+    picks = iter([rng.choice(usernames) for _ in range(operations)] * 3)
+    seconds = _time_per_call(lambda: board.add(next(picks), 1), operations)
+    print(f"  add points:  {seconds * 1e6:>6.2f} us/update")
+    seconds = _time_per_call(lambda: board.rank(next(picks)), operations)
+    print(f"  rank lookup: {seconds * 1e6:>6.2f} us/lookup")
+    seconds = _time_per_call(lambda: board.page(0, 10), operations)
+    print(f"  top 10:      {seconds * 1e6:>6.2f} us/page")
+    deep = players // 2
+    seconds = _time_per_call(lambda: board.page(deep, 10), operations // 10)
+    print(f"  10 at rank {deep}: {seconds * 1e6:.2f} us/page")
+
+    # The structure-free alternative: count higher scores on every lookup
+    scores = dict(items)
+    member = next(picks)
+    seconds = _time_per_call(lambda: 1 + sum(1 for score in scores.values() if score > scores[member]), 5)
+    print(f"  naive rank (full scan): {seconds * 1e3:.1f} ms/lookup")
+
+BENCHMARKS = {
+    "identity": bench_identity,
+    "persistence": bench_persistence,
+    "rules": bench_rules,
+    "lobbies": bench_lobbies,
+    "messages": bench_messages,
+    "trivia_bank": bench_trivia_bank,
+    "leaderboard": bench_leaderboard,
+}
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        BENCHMARKS[name]()
@@ -0,0 +1,175 @@
+"""Workers sharing one socket bus, each a separate uvicorn process (needs requirements-dev.txt)"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+from websockets.sync.client import connect
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_worker(port: int, bus_path: str) -> subprocess.Popen:
+    env = dict(os.environ, BROADCAST_BUS="socket", BROADCAST_BUS_PATH=bus_path,
+               MESSAGE_LOG_PATH="", LEADERBOARD_SNAPSHOT_PATH="")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=env
+    )
+
+def wait_for_bus(url: str, roles: set, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/healthz").json()["broadcast_bus"]["role"] in roles:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"{url} never joined the bus")
+
+def eventually(check, timeout: float = 5.0):
+    """Poll until `check()` returns a truthy value, which is returned"""
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result or time.monotonic() > deadline:
+            assert result, "condition not met in time"
+            return result
+        time.sleep(0.05)
+
+@pytest.fixture
+def cluster(tmp_path):
+    """Starts workers on one bus: `cluster(role)` returns the new worker's (url, process)"""
+    bus_path = str(tmp_path / "bus.sock")
+    procs = []
+
+    def start(role: str):
+        port = free_port()
+        procs.append(start_worker(port, bus_path))
+        url = f"http://127.0.0.1:{port}"
+        wait_for_bus(url, {role})
+        return url, procs[-1]
+
+    try:
+        yield start
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+@pytest.fixture
+def workers(cluster):
+    (a, _), (b, _) = cluster("broker"), cluster("peer")
+    return a, b
+
+def lobby_users(url: str, lobby_id: str) -> list:
+    return httpx.get(f"{url}/lobbies/{lobby_id}/info").json()["users"]
+
+def receive_until(ws, predicate, timeout: float = 5.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        frame = json.loads(ws.recv(timeout=max(0.0, deadline - time.monotonic())))
+        if predicate(frame):
+            return frame
+
+def test_lobby_created_on_one_worker_is_usable_from_the_other(workers):
+    a, b = workers
+
+    # Users and the lobby are only ever created on worker A
+    alice = httpx.post(f"{a}/register", json={"username": "alice"}).json()["user_id"]
+    bob = httpx.post(f"{a}/register", json={"username": "bob"}).json()["user_id"]
+    lobby_id = httpx.post(f"{a}/lobbies", json={"name": "Shared"}).json()["lobby_id"]
+    assert httpx.post(f"{a}/lobbies/join-public", json={"lobby_id": lobby_id, "user_id": alice}).status_code == 200
+    eventually(lambda: lobby_users(b, lobby_id) == ["alice"])
+
+    # Worker B knows both users and the lobby
+    joined = httpx.post(f"{b}/lobbies/join-public", json={"lobby_id": lobby_id, "user_id": bob})
+    assert joined.status_code == 200, joined.text
+    eventually(lambda: lobby_users(a, lobby_id) == ["alice", "bob"])
+
+    with connect(f"ws://{a[len('http://'):]}/ws/{lobby_id}/{alice}", close_timeout=1) as ws_a, \
+            connect(f"ws://{b[len('http://'):]}/ws/{lobby_id}/{bob}", close_timeout=1) as ws_b:
+        receive_until(ws_b, lambda frame: frame.get("type") == "system")  # Welcome, not a 1008 close
+
+        ws_a.send(json.dumps({"message": "hello from A"}))
+        frame = receive_until(ws_b, lambda frame: frame.get("message") == "hello from A")
+        assert frame["username"] == "alice"
+
+        ws_b.send(json.dumps({"message": "hello from B", "reply_to": frame["message_id"]}))
+        reply = receive_until(ws_a, lambda frame: frame.get("message") == "hello from B")
+        assert reply["replied_message"]["message"] == "hello from A"
+
+    # History is the same on both workers
+    for url in (a, b):
+        eventually(lambda: user_messages(url, lobby_id) == ["hello from A", "hello from B"])
+
+def user_messages(url: str, lobby_id: str) -> list:
+    messages = httpx.get(f"{url}/lobbies/{lobby_id}/messages").json()["messages"]
+    return [m["message"] for m in messages if m["type"] == "user"]
+
+def test_worker_started_later_gets_the_existing_registry(cluster):
+    a, _ = cluster("broker")
+    alice = httpx.post(f"{a}/register", json={"username": "alice"}).json()["user_id"]
+    lobby_id = httpx.post(f"{a}/lobbies", json={"name": "Early"}).json()["lobby_id"]
+    assert httpx.post(f"{a}/lobbies/join-public", json={"lobby_id": lobby_id, "user_id": alice}).status_code == 200
+    with connect(f"ws://{a[len('http://'):]}/ws/{lobby_id}/{alice}", close_timeout=1) as ws:
+        receive_until(ws, lambda frame: frame.get("type") == "system")
+        ws.send(json.dumps({"message": "before B existed"}))
+        receive_until(ws, lambda frame: frame.get("message") == "before B existed")
+
+        # B serves only once it holds everything A had
+        b, _ = cluster("peer")
+        assert httpx.get(f"{b}/lobbies").json()["total_count"] == 1
+        assert lobby_users(b, lobby_id) == ["alice"]
+        assert httpx.get(f"{b}/lobbies/{lobby_id}/info").json()["active_users"] == ["alice"]
+        assert user_messages(b, lobby_id) == ["before B existed"]
+        assert httpx.post(f"{b}/register", json={"username": "alice"}).status_code == 400
+
+def test_username_is_registered_once_across_workers(workers):
+    a, b = workers
+    statuses = []
+
+    def register(url: str):
+        statuses.append(httpx.post(f"{url}/register", json={"username": "carol"}).status_code)
+
+    threads = [threading.Thread(target=register, args=(url,)) for url in (a, b)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(statuses) == [200, 400]
+
+def test_killed_worker_leaves_no_presence_or_round_behind(cluster):
+    (a, _), (b, proc_b) = cluster("broker"), cluster("peer")
+    ids = [httpx.post(f"{a}/register", json={"username": name}).json()["user_id"] for name in ("bob", "dan")]
+    lobby_id = httpx.post(f"{a}/lobbies", json={"name": "Crash"}).json()["lobby_id"]
+    for user_id in ids:
+        assert httpx.post(f"{a}/lobbies/join-public", json={"lobby_id": lobby_id, "user_id": user_id}).status_code == 200
+    eventually(lambda: lobby_users(b, lobby_id) == ["bob", "dan"])
+
+    # Both users are on B, which also starts (and owns) the trivia round
+    sockets = [connect(f"ws://{b[len('http://'):]}/ws/{lobby_id}/{user_id}", close_timeout=1) for user_id in ids]
+    for ws in sockets:
+        receive_until(ws, lambda frame: frame.get("type") == "system")
+    info = lambda: httpx.get(f"{a}/lobbies/{lobby_id}/info").json()
+    eventually(lambda: sorted(info()["active_users"]) == ["bob", "dan"])
+    for n in range(8):
+        sockets[0].send(json.dumps({"message": f"message {n}"}))
+    eventually(lambda: info()["trivia_active"])
+
+    proc_b.kill()  # No graceful shutdown: the sockets' own cleanup never runs
+    proc_b.wait(timeout=10)
+    eventually(lambda: info()["active_users"] == [] and not info()["trivia_active"])
+    for ws in sockets:
+        ws.close()
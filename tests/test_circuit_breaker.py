@@ -0,0 +1,112 @@
+"""CircuitBreaker state transitions on a fake clock"""
+import pytest
+
+import main
+from main import CircuitBreaker
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+def make_breaker(**overrides) -> CircuitBreaker:
+    options = dict(window=10, min_calls=4, error_rate=0.5, slow_call=2.0, slow_rate=0.5,
+                   cooldown=10.0, max_cooldown=30.0)
+    options.update(overrides)
+    return CircuitBreaker("test", **options)
+
+def trip(breaker: CircuitBreaker):
+    for _ in range(breaker.min_calls):
+        breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.OPEN
+
+def test_opens_once_enough_recent_calls_fail(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED  # Below min_calls
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.OPEN  # 3 of 4 failed
+    assert breaker.opened_total == 1
+
+    assert not breaker.allow()
+    assert breaker.rejected_total == 1
+    breaker.record(False, 0.1)  # Outcomes while open (calls already in flight) are ignored
+    assert breaker.state == CircuitBreaker.OPEN
+
+def test_old_outcomes_leave_the_window(clock):
+    breaker = make_breaker(window=4, min_calls=4)
+    for ok in (False, True, False, True):
+        breaker.record(ok, 0.1)
+    assert breaker.state == CircuitBreaker.OPEN  # 2 of 4 is the threshold
+
+    breaker = make_breaker(window=4, min_calls=4)
+    breaker.record(False, 0.1)
+    for _ in range(4):
+        breaker.record(True, 0.1)  # The failure slides out
+    breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["recent_error_rate"] == 0.25
+
+def test_slow_and_cancelled_calls_count_as_slow(clock):
+    breaker = make_breaker()
+    breaker.record(True, 0.1)
+    breaker.record(True, 0.1)
+    breaker.record(True, 5.0)
+    breaker.record_cancelled(0.5)  # Abandoned early still counts as a slow call
+    assert breaker.state == CircuitBreaker.OPEN
+
+def test_probe_success_closes_and_resets_the_cooldown(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.now += 9.9
+    assert not breaker.allow()
+    clock.now += 0.1
+    assert breaker.allow()  # The probe
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # Only one probe at a time
+
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.cooldown == 10.0
+    assert breaker.stats()["recent_calls"] == 0
+    assert breaker.allow()
+
+def test_probe_failure_reopens_with_a_longer_cooldown(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    for expected in (20.0, 30.0, 30.0):  # Doubled, then capped at max_cooldown
+        clock.now += breaker.cooldown
+        assert breaker.allow()
+        breaker.record(False, 0.1)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.cooldown == expected
+        assert not breaker.allow()
+
+    clock.now += breaker.cooldown
+    assert breaker.allow()
+    breaker.record(True, 5.0)  # A slow probe fails too
+    assert breaker.state == CircuitBreaker.OPEN
+
+def test_unreported_probe_frees_the_slot_after_a_cooldown(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.now += 10.0
+    assert breaker.allow()  # Probe goes out and never records (e.g. answered from cache)
+    clock.now += 9.0
+    assert not breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    clock.now += 1.0
+    assert breaker.allow()  # A new probe
+    assert not breaker.allow()
+
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,103 @@
+"""InferencePool slot limits and priority hand-off"""
+import asyncio
+
+from main import InferencePool
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_slots_are_never_exceeded():
+    async def scenario():
+        pool = InferencePool("test", slots=2, max_depth=10, max_age=5)
+        assert await pool.acquire(1) and await pool.acquire(1)
+        waiter = asyncio.create_task(pool.acquire(1))
+        await settle()
+        assert not waiter.done()
+        assert pool.stats() == {"slots": 2, "busy": 2, "queued": 1, "dropped": 0}
+
+        pool.release()  # Handed straight to the waiter: still two busy
+        assert await waiter
+        assert pool.busy == 2
+        pool.release()
+        pool.release()
+        assert pool.busy == 0
+
+    run(scenario())
+
+def test_waiters_get_slots_by_priority_then_arrival():
+    async def scenario():
+        pool = InferencePool("test", slots=1, max_depth=10, max_age=5)
+        assert await pool.acquire(0)
+        order = []
+
+        async def wait(name, priority):
+            assert await pool.acquire(priority)
+            order.append(name)
+
+        tasks = []
+        for name, priority in [("chatter", 2), ("direct-1", 0), ("normal", 1), ("direct-2", 0)]:
+            tasks.append(asyncio.create_task(wait(name, priority)))
+            await settle()
+        # A newcomer queues behind the waiters even though it is the best priority
+        tasks.append(asyncio.create_task(wait("direct-3", 0)))
+        await settle()
+        assert order == []
+
+        for _ in tasks:
+            pool.release()
+            await settle()
+        assert order == ["direct-1", "direct-2", "direct-3", "normal", "chatter"]
+        assert pool.busy == 1
+        await asyncio.gather(*tasks)
+
+    run(scenario())
+
+def test_full_queue_and_expired_waiters_are_dropped():
+    async def scenario():
+        pool = InferencePool("test", slots=1, max_depth=1, max_age=0.05)
+        assert await pool.acquire(1)
+        waiter = asyncio.create_task(pool.acquire(1))
+        await settle()
+        assert not await pool.acquire(0)  # Queue full, even for the best priority
+        assert not await waiter  # Expired after max_age
+        assert pool.dropped == 2
+        assert pool.stats()["queued"] == 0
+
+        pool.release()
+        assert pool.busy == 0
+        assert await pool.acquire(1)  # Nothing left queued, so the slot is free again
+
+    run(scenario())
+
+def test_cancelled_waiter_passes_its_slot_on():
+    async def scenario():
+        pool = InferencePool("test", slots=1, max_depth=10, max_age=5)
+        assert await pool.acquire(1)
+        first = asyncio.create_task(pool.acquire(0))
+        second = asyncio.create_task(pool.acquire(1))
+        await settle()
+
+        first.cancel()
+        await settle()
+        pool.release()
+        assert await second
+        assert pool.busy == 1
+
+        # Cancelled just after the hand-off: depending on the Python version the waiter
+        # either keeps the slot or passes it to the next one, but it is never lost
+        third = asyncio.create_task(pool.acquire(1))
+        fourth = asyncio.create_task(pool.acquire(1))
+        await settle()
+        pool.release()
+        third.cancel()
+        await settle()
+        holders = [task for task in (third, fourth) if task.done() and not task.cancelled() and task.result()]
+        assert len(holders) == 1
+        assert pool.busy == 1
+        fourth.cancel()
+
+    run(scenario())
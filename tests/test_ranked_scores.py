@@ -0,0 +1,75 @@
+"""RankedScores checked against a plain sorted list"""
+import random
+
+import pytest
+
+from main import RankedScores
+
+class SmallBuckets(RankedScores):
+    LOAD = 4  # Split and merge buckets after a handful of members
+
+def oracle_page(scores: dict, offset: int, limit: int) -> list:
+    ordered = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return [(oracle_rank(scores, member), member, score) for member, score in ordered[offset:offset + limit]]
+
+def oracle_rank(scores: dict, member: str) -> int:
+    return 1 + sum(1 for score in scores.values() if score > scores[member])
+
+def assert_matches(board: RankedScores, scores: dict):
+    assert len(board) == len(scores)
+    for member in scores:
+        assert board.rank(member) == oracle_rank(scores, member), member
+    assert list(board.items()) == [(member, score) for _, member, score in oracle_page(scores, 0, len(scores))]
+    for offset in range(0, len(scores) + 3, 3):
+        for limit in (1, 5, 50):
+            assert board.page(offset, limit) == oracle_page(scores, offset, limit), (offset, limit)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_updates_match_a_sorted_list(seed):
+    rng = random.Random(seed)
+    board, scores = SmallBuckets(), {}
+    members = [f"player{i:02d}" for i in range(40)]
+    for step in range(600):
+        member = rng.choice(members)
+        action = rng.random()
+        if action < 0.6:
+            points = rng.randint(1, 3)
+            assert board.add(member, points) == scores.get(member, 0) + points
+            scores[member] = scores.get(member, 0) + points
+        elif action < 0.85:
+            score = rng.randint(0, 10)  # Small range: plenty of ties
+            board.set(member, score)
+            scores[member] = score
+        else:
+            board.remove(member)
+            scores.pop(member, None)
+        if step % 50 == 0:
+            assert_matches(board, scores)
+    assert_matches(board, scores)
+
+def test_ties_share_a_rank_and_are_listed_by_name():
+    board = SmallBuckets.from_items([("carol", 5), ("alice", 5), ("bob", 7), ("dave", 1)])
+    assert board.page(0, 10) == [(1, "bob", 7), (2, "alice", 5), (2, "carol", 5), (4, "dave", 1)]
+    # A page starting inside a tie still reports the tie's rank
+    assert board.page(2, 2) == [(2, "carol", 5), (4, "dave", 1)]
+    assert board.rank("carol") == 2
+
+def test_bulk_build_matches_incremental_updates():
+    rng = random.Random(7)
+    scores = {f"m{i}": rng.randint(0, 20) for i in range(50)}
+    built = SmallBuckets.from_items(scores.items())
+    incremental = SmallBuckets()
+    for member, score in scores.items():
+        incremental.set(member, score)
+    assert list(built.items()) == list(incremental.items())
+    assert_matches(built, scores)
+
+def test_unknown_members_and_empty_pages():
+    board = RankedScores()
+    assert board.rank("nobody") is None
+    assert board.score("nobody") is None
+    assert board.page(0, 10) == []
+    board.add("alice", 1)
+    board.remove("nobody")
+    assert board.page(1, 10) == []
+    assert board.page(0, 0) == []